@@ -143,34 +143,50 @@ class SimulationSequenceElement(MarxsElement):
         - `output_columns`
         - the ``colnames`` parameter.
 
+        All new columns are inserted into the table in a single operation.
+
         Parameters
         ----------
         photons : `astropy.table.Table`
             Table columns are added to.
         colnames : list of elements
             Each element can be a string (in this case a float column with
-            initial value ``np.nan`` is added) or a dictionay of arguments
-            for `astropy.table.column.Column`. If the dictionay has a keys
+            initial value ``np.nan`` is added), a dictionay of arguments
+            for `astropy.table.column.Column`, or a `astropy.table.Column`
+            that is added as it is. If the dictionay has a keys
             "value" then the column will be initialized to that value.
             Column names to be added; in addition several object properties can
             be used to set the column names, see description above.
         '''
+        newcols = []
+        newnames = set()
         for n in self.output_columns + colnames:
-            if (n is not None) and (n not in photons.colnames):
-                if not isinstance(n, dict):
-                    n = {'name': n, 'value': np.nan}
+            if n is None:
+                continue
+            if not isinstance(n, (dict, Column)):
+                n = {'name': n, 'value': np.nan}
+            name = n.name if isinstance(n, Column) else n['name']
+            if (name in photons.colnames) or (name in newnames):
+                continue
+            if isinstance(n, Column):
+                newcol = n
+            else:
+                n = n.copy()
                 val = n.pop('value', None)
                 newcol = Column(length=len(photons), **n)
                 if val is not None:
                     newcol[:] = val
-                photons.add_column(newcol)
-
-        # We can call this recursively, because the column will be added
-        # before reaching this line agian, so we avoid infinite recursion.
-        if (self.id_col is not None) and (self.id_col not in photons.colnames):
-            self.add_output_cols(photons, colnames=[{'name': self.id_col,
-                                                     'dtype': int,
-                                                     'value': -1}])
+            newcols.append(newcol)
+            newnames.add(name)
+
+        if ((self.id_col is not None) and (self.id_col not in photons.colnames)
+                and (self.id_col not in newnames)):
+            newcol = Column(name=self.id_col, dtype=int, length=len(photons))
+            newcol[:] = -1
+            newcols.append(newcol)
+
+        if len(newcols) > 0:
+            photons.add_columns(newcols, copy=False)
 
     def __call__(self, photons, *args, **kwargs):
         return self.process_photons(photons, *args, **kwargs)
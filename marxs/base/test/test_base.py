@@ -1,7 +1,7 @@
 # Licensed under GPL version 3 - see LICENSE.rst
 import pytest
 import numpy as np
-from astropy.table import Table
+from astropy.table import Table, Column
 
 from ..base import _parse_position_keywords
 from ..base import SimulationSequenceElement as SSE
@@ -47,6 +47,21 @@ def test_add_output_cols():
     assert np.issubdtype(photons['123'].dtype, np.integer)
 
 
+def test_add_output_cols_column():
+    '''Column objects are added as they are, dict specs can be reused.'''
+    class T(SSE):
+        output_columns = [{'name': 'b', 'dtype': int, 'value': 5}]
+        id_col = 'my_id'
+
+    for i in range(2):
+        photons = Table({'a': [1, 2]})
+        t = T()
+        t.add_output_cols(photons, [Column([3, 4], name='c'), 'c'])
+        assert photons.colnames == ['a', 'b', 'c', 'my_id']
+        assert np.all(photons['b'] == 5)
+        assert np.all(photons['c'] == [3, 4])
+
+
 def test_add_idnum_col():
     '''Text another mechanism to add output columns'''
     class T(SSE):
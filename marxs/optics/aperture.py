@@ -1,4 +1,6 @@
 # Licensed under GPL version 3 - see LICENSE.rst
+import math
+
 import numpy as np
 from astropy import table
 import astropy.units as u
@@ -8,20 +10,97 @@ from ..base import GeometryError
 from ..math.geometry import RectangleHole, CircularHole
 from ..simulator import BaseContainer
 
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+USE_NUMBA = HAS_NUMBA
+'''Use the compiled numba kernels if numba is installed.
+
+Set ``marxs.optics.aperture.USE_NUMBA = False`` to force the numpy code path,
+e.g. to avoid the JIT compilation on the first call or to keep the parallel
+kernels from competing for threads with an outer parallelization.
+'''
+
+_rng = np.random.default_rng()
+
+
+if HAS_NUMBA:
+    @njit(parallel=True, cache=True)
+    def _sample_annulus(rand, phi0, dphi, r2_inner, one_minus_r2_inner,
+                        out_x, out_y):
+        '''Transform uniform random numbers to x, y in a ring segment.
+
+        This fuses the calculation of phi, r, and x, y into a single
+        loop without temporary arrays. cos and sin are evaluated next to
+        each other on the same ``phi``, so that the compiler can merge them
+        into one ``sincos`` call.
+        '''
+        for i in prange(rand.shape[0]):
+            phi = phi0 + dphi * rand[i, 0]
+            r = math.sqrt(r2_inner + one_minus_r2_inner * rand[i, 1])
+            out_x[i] = r * math.cos(phi)
+            out_y[i] = r * math.sin(phi)
+
+    @njit(parallel=True, cache=True)
+    def _place_photons(pos, dirv, prob, x, y, vy, vz, c, neg_ex):
+        '''Compiled version of `FlatAperture._apply_numeric`.
+
+        Position, projected area and probability of each photon are
+        calculated in a single pass over the arrays.
+        '''
+        for i in prange(pos.shape[0]):
+            for j in range(4):
+                pos[i, j] = c[j] + x[i] * vy[j] + y[i] * vz[j]
+            p = (dirv[i, 0] * neg_ex[0] + dirv[i, 1] * neg_ex[1] +
+                 dirv[i, 2] * neg_ex[2] + dirv[i, 3] * neg_ex[3])
+            # Branchless clipping to 0..1 (see _apply_numeric for the bounds)
+            prob[i] *= min(max(p, 0.), 1.)
+
 
 class BaseAperture(object):
-    '''Base Aperture class'''
+    '''Base Aperture class
+
+    Parameters
+    ----------
+    seed : None, int, or `numpy.random.Generator`
+        Seed for the random number generator that places photons in the
+        aperture. Set this to get reproducible results. If ``None``
+        (default), all apertures share one module-level generator.
+        A seeded `MultiAperture` passes independent child generators to
+        all its elements that do not have a seed of their own.
+    '''
 
     display = {'color': (0.0, 0.75, 0.75),
                'opacity': 0.3,
                'shape': 'triangulation'}
 
+    dtype = np.float64
+    '''Floating point type for the positions of new photons.
+
+    Set this to ``np.float32`` to halve the memory used for the random
+    positions and the ``pos`` column, at the cost of numerical precision.
+    '''
+
+    def __init__(self, **kwargs):
+        seed = kwargs.pop('seed', None)
+        self._has_seed = seed is not None
+        self._rng = _rng if seed is None else np.random.default_rng(seed)
+        super().__init__(**kwargs)
+
+    def _set_default_rng(self, rng):
+        '''Use ``rng`` unless the aperture was initialized with its own seed.'''
+        if not self._has_seed:
+            self._rng = rng
+
     @staticmethod
-    def add_colpos(photons):
+    def add_colpos(photons, dtype=np.float64):
         '''add columns ['pos'] to photon array'''
         if 'pos' not in photons.colnames:
             photoncoords = table.Column(name='pos', length=len(photons),
-                                        shape=(4,))
+                                        shape=(4,), dtype=dtype)
             photons.add_column(photoncoords)
             photons['pos'][:, 3] = 1
             photons['pos'].unit = u.mm
@@ -39,12 +118,60 @@ class BaseAperture(object):
 class FlatAperture(BaseAperture, FlatOpticalElement):
     'Base class for geometrically flat apertures defined in python'
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._cache_geom()
+        # Scratch buffer for the projected area in the numpy code path of
+        # _apply_numeric, reused between calls. It grows to the largest batch
+        # processed so far and is kept as long as the aperture exists; that
+        # memory is traded for fewer allocations. With numba, the compiled
+        # kernel needs no buffer and this stays None.
+        self._proj_buf = None
+
+    def _cache_geom(self):
+        '''Cache the geometry vectors that are used to process photons.
+
+        Looking them up through ``self.geometry`` on every call has a
+        noticeable overhead when many small batches of photons are processed.
+        '''
+        self._pos4d = self.geometry.pos4d.copy()
+        self._c = np.array(self.geometry['center'])
+        self._vy = np.array(self.geometry['v_y'])
+        self._vz = np.array(self.geometry['v_z'])
+        self._ex = np.array(self.geometry['e_x'])
+        self._neg_ex = - self._ex
+        # Plain scalar arithmetic is much faster than np.linalg.norm for
+        # vectors with only three elements.
+        self._vy_norm = math.sqrt(self._vy[0]**2 + self._vy[1]**2 + self._vy[2]**2)
+        self._vz_norm = math.sqrt(self._vz[0]**2 + self._vz[1]**2 + self._vz[2]**2)
+
+    def _update_geom(self):
+        '''Refresh cached geometry if ``pos4d`` changed since it was cached.
+
+        This happens e.g. when elements are moved by the functions in
+        `marxs.design.tolerancing`.
+        '''
+        if not np.array_equal(self._pos4d, self.geometry.pos4d):
+            self._cache_geom()
+
     def __call__(self, photons):
         # The last two arguments make no sense for apertures - the
         # intercoos and interpoos are assigned in specific_process_photons
         # instead of derived from intersect - but we need something here
         # to keep the interface the same as in FlatOpticalElement.
-        self.add_colpos(photons)
+        newcols = []
+        if 'pos' not in photons.colnames:
+            # All photons pass the aperture and _apply_numeric sets all four
+            # components of pos, so the column does not need to be
+            # initialized (see add_colpos).
+            newcols.append(table.Column(np.empty((len(photons), 4),
+                                                 dtype=self.dtype),
+                                        name='pos', unit=u.mm, copy=False))
+        if self.loc_coos_name is not None:
+            newcols.extend(self.loc_coos_name)
+        # Add all new columns at once instead of one by one as
+        # process_photons would do.
+        self.add_output_cols(photons, newcols)
         self.process_photons(photons, np.ones(len(photons), dtype=bool),
                              photons['pos'],
                              np.zeros((len(photons), 2)))
@@ -65,17 +192,71 @@ class FlatAperture(BaseAperture, FlatOpticalElement):
         '''
         return NotImplementedError
 
-    def specific_process_photons(self, photons, intersect, interpos, intercoos):
-        x, y = self.generate_local_xy(intersect.sum())
+    def _apply_numeric(self, pos, dir, prob, x, y):
+        '''Place photons on the aperture and update their probability.
 
-        intercoos[intersect, 0] = x
-        intercoos[intersect, 1] = y
-        interpos[intersect, :] = self.geometry['center'] + x.reshape((-1, 1)) * self.geometry['v_y'] + y.reshape((-1, 1)) * self.geometry['v_z']
-        projected_area = np.dot(photons['dir'][intersect].data,
-                                - self.geometry['e_x'])
+        This works on plain numpy arrays and modifies ``pos`` and ``prob``
+        in place. Pass views of table columns to write into a table directly.
+
+        Parameters
+        ----------
+        pos : `numpy.ndarray` of shape (N, 4)
+            Output array for the homogeneous positions of the photons.
+        dir : `numpy.ndarray` of shape (N, 4)
+            Homogeneous direction vectors of the photons.
+        prob : `numpy.ndarray` of shape (N,)
+            Probabilities of the photons; multiplied by the projected area.
+        x, y : `numpy.ndarray` of shape (N,)
+            Photon coordinates in the local frame, see `generate_local_xy`.
+        '''
+        if USE_NUMBA:
+            _place_photons(pos, dir, prob, x, y, self._vy, self._vz, self._c,
+                           self._neg_ex)
+            return
+
+        # Build the positions in a single output buffer instead of summing
+        # several temporary (N, 4) arrays.
+        np.multiply(x[:, None], self._vy, out=pos)
+        pos += y[:, None] * self._vz
+        pos += self._c
+        if self._proj_buf is None or self._proj_buf.size < len(x):
+            self._proj_buf = np.empty(len(x))
+        projected_area = self._proj_buf[:len(x)]
+        np.einsum('ij,j->i', dir, self._neg_ex, out=projected_area)
         # Photons coming "through the back" would have negative probabilities.
         # Unlikely to ever come up, but just in case we clip to 0.
-        return {'probability': np.clip(projected_area, 0, 1.)}
+        # The upper limit is not dead code: For rays exactly anti-parallel to
+        # a tilted aperture the dot product of two unit vectors can exceed 1
+        # by rounding errors.
+        np.clip(projected_area, 0, 1., out=projected_area)
+        prob *= projected_area
+
+    def specific_process_photons(self, photons, intersect, interpos, intercoos):
+        self._update_geom()
+        if intersect.all():
+            x, y = self.generate_local_xy(len(intersect))
+            intercoos[:, 0] = x
+            intercoos[:, 1] = y
+            # np.asarray of a column is a view, so the results are written
+            # into the table without any intermediate copies.
+            self._apply_numeric(np.asarray(interpos),
+                                np.asarray(photons['dir']),
+                                np.asarray(photons['probability']), x, y)
+        else:
+            # e.g. one of several apertures in a MultiAperture.
+            # Convert the mask to indices once instead of scanning the full
+            # boolean array again for every column below.
+            ind = np.flatnonzero(intersect)
+            x, y = self.generate_local_xy(len(ind))
+            intercoos[ind, 0] = x
+            intercoos[ind, 1] = y
+            pos = np.empty((len(ind), 4), dtype=self.dtype)
+            prob = photons['probability'].data[ind]
+            self._apply_numeric(pos, photons['dir'].data[ind], prob, x, y)
+            interpos[ind, :] = pos
+            photons['probability'][ind] = prob
+        # Probabilities are already updated above.
+        return {}
 
     def outer_shape(self):
         '''Return values in Eukledian space.'''
@@ -85,19 +266,53 @@ class FlatAperture(BaseAperture, FlatOpticalElement):
 class RectangleAperture(FlatAperture):
     '''Select the position where a parallel ray from an astrophysical source starts the simulation.
 
+    Parameters
+    ----------
+    stratify : bool
+        If ``True``, photons are placed with stratified (jittered) sampling:
+        The aperture is divided into a grid of cells and each cell receives
+        one photon at a random position within that cell. This covers the
+        aperture more evenly than pure random sampling and thus reduces the
+        noise in simulations that integrate over the aperture. The default is
+        ``False``.
+
     '''
 
     default_geometry = RectangleHole
 
+    def __init__(self, **kwargs):
+        self.stratify = kwargs.pop('stratify', False)
+        super().__init__(**kwargs)
+
     def generate_local_xy(self, n):
-        x = np.random.random(n) * 2. - 1.
-        y = np.random.random(n) * 2. - 1.
-        return x, y
+        if self.stratify:
+            # Place one point in each cell of an s * s grid and select n of
+            # them in random order, so that position and photon number are
+            # not correlated.
+            s = max(int(np.ceil(np.sqrt(n))), 1)
+            ix, iy = np.divmod(np.arange(s * s), s)
+            xy = self._rng.random((s * s, 2), dtype=self.dtype)
+            xy[:, 0] += ix
+            xy[:, 1] += iy
+            xy *= 2. / s
+            xy -= 1.
+            xy = self._rng.permutation(xy)[:n]
+            return xy[:, 0], xy[:, 1]
+
+        xy = self._rng.random((n, 2), dtype=self.dtype)
+        xy *= 2.
+        xy -= 1.
+        return xy[:, 0], xy[:, 1]
+
+    def _cache_geom(self):
+        super()._cache_geom()
+        self._area = 4 * self._vy_norm * self._vz_norm * u.mm**2
 
     @property
     def area(self):
         '''Area covered by the aperture'''
-        return 4 * np.linalg.norm(self.geometry['v_y']) * np.linalg.norm(self.geometry['v_z']) * u.mm**2
+        self._update_geom()
+        return self._area
 
 
 class CircleAperture(FlatAperture):
@@ -136,21 +351,40 @@ class CircleAperture(FlatAperture):
                           np.linalg.norm(self.geometry['v_z'])):
             raise GeometryError('Aperture does not have the same size in y, z direction.')
 
-    def generate_local_xy(self, n):
-        phi = np.random.uniform(self.geometry.phi[0], self.geometry.phi[1], n)
+    def _cache_geom(self):
+        super()._cache_geom()
+        # Constants for the sampling in generate_local_xy
+        self._phi0 = self.geometry.phi[0]
+        self._phi_width = self.geometry.phi[1] - self.geometry.phi[0]
         # normalize r_inner
-        r_inner = self.geometry['r_inner'] / np.linalg.norm(self.geometry['v_y'])
-        r = np.sqrt(np.random.uniform(r_inner**2, 1., n))
+        self._r_inner2 = (self.geometry['r_inner'] / self._vy_norm)**2
+        self._one_minus_r2 = 1. - self._r_inner2
+        A_circ = np.pi * (self._vy_norm**2 - self.geometry['r_inner']**2)
+        self._area = self._phi_width / (2 * np.pi) * A_circ * u.mm**2
 
-        x = r * np.cos(phi)
-        y = r * np.sin(phi)
+    def generate_local_xy(self, n):
+        rand = self._rng.random((n, 2), dtype=self.dtype)
+        x = np.empty(n, dtype=self.dtype)
+        y = np.empty(n, dtype=self.dtype)
+        if USE_NUMBA:
+            _sample_annulus(rand, self._phi0, self._phi_width, self._r_inner2,
+                            self._one_minus_r2, x, y)
+        else:
+            phi = self._phi0 + self._phi_width * rand[:, 0]
+            r = np.sqrt(self._r_inner2 + self._one_minus_r2 * rand[:, 1])
+            # numpy has no sincos, but we can at least write cos and sin
+            # straight into the output and scale in place.
+            np.cos(phi, out=x)
+            np.sin(phi, out=y)
+            x *= r
+            y *= r
         return x, y
 
     @property
     def area(self):
         '''Area covered by the aperture'''
-        A_circ = np.pi * (np.linalg.norm(self.geometry['v_y'])**2 - self.geometry['r_inner']**2)
-        return (self.geometry.phi[1] - self.geometry.phi[0])  / (2 * np.pi) * A_circ * u.mm**2
+        self._update_geom()
+        return self._area
 
 
 class MultiAperture(BaseAperture, BaseContainer):
@@ -186,24 +420,93 @@ class MultiAperture(BaseAperture, BaseContainer):
     display = {'shape': 'container'}
 
     def __init__(self, **kwargs):
-        self.elements = kwargs.pop('elements')
         self.id_col = kwargs.pop('id_col', 'aperture')
         self.id_num_offset = kwargs.pop('id_num_offset', 0)
+        self.elements = kwargs.pop('elements')
         super().__init__(**kwargs)
+        self._seed_elements()
+
+    def _number_elements(self):
         for i, elem in enumerate(self.elements):
             elem.id_col = self.id_col
             elem.id_num = self.id_num_offset + i
 
+    def _set_default_rng(self, rng):
+        super()._set_default_rng(rng)
+        self._seed_elements()
+
+    def _seed_elements(self):
+        '''Give elements without their own seed a child of our generator.
+
+        Without this, a seed for the `MultiAperture` would only fix which
+        aperture a photon goes through, but not where it hits that aperture.
+        '''
+        if self._rng is _rng:
+            return
+        entropy = self._rng.integers(2**63, size=4)
+        children = np.random.SeedSequence(entropy).spawn(len(self.elements))
+        for elem, child in zip(self.elements, children):
+            if hasattr(elem, '_set_default_rng'):
+                elem._set_default_rng(np.random.default_rng(child))
+
+    @property
+    def elements(self):
+        '''List of apertures in this container.
+
+        To change the apertures, assign a new list; this numbers and seeds the
+        new apertures. Modifying the list in place (e.g. with ``append``) does
+        not set the ``id_col`` or the random number generator of the new
+        aperture.
+        '''
+        return self._elements
+
+    @elements.setter
+    def elements(self, value):
+        self._elements = value
+        self._areas = None
+        self._update_areas()
+        self._number_elements()
+        # During __init__ the generator does not exist yet; __init__ seeds
+        # the elements once it does.
+        if hasattr(self, '_rng'):
+            self._seed_elements()
+
+    def _update_areas(self):
+        '''Recompute the area distribution if any element area changed.
+
+        The cumulative distribution of the areas decides which aperture a
+        photon goes through. Element areas are cheap to look up, but building
+        the distribution is not, so it is only rebuilt when an area changed,
+        e.g. because an element was moved or rescaled.
+        '''
+        areas = [e.area for e in self.elements]
+        if ((self._areas is not None) and (len(areas) == len(self._areas)) and
+            all((a is b) or (a == b) for a, b in zip(areas, self._areas))):
+            return
+        self._areas = areas
+        areas = u.Quantity(areas)
+        self._total_area = areas.sum()
+        self._cdf = (np.cumsum(areas) / self._total_area).value
+        # Make sure rounding errors cannot leave a photon without aperture.
+        if len(self._cdf) > 0:
+            self._cdf[-1] = 1.
+
     @property
     def area(self):
         '''Area covered by the aperture'''
-        return u.Quantity([e.area for e in self.elements]).sum()
+        self._update_areas()
+        return self._total_area
 
     def __call__(self, photons):
-        self.add_colpos(photons)
-        areas = u.Quantity([e.area for e in self.elements])
-        aperid = np.digitize(np.random.rand(len(photons)), np.cumsum(areas) / self.area)
-        np.random.shuffle(aperid)
+        self.add_colpos(photons, dtype=self.dtype)
+        self._update_areas()
+        # Random numbers are drawn independently for each photon, so the
+        # apertures are not sorted in time [#189].
+        aperid = np.searchsorted(self._cdf, self._rng.random(len(photons)),
+                                 side='right')
+        # Each aperture only touches the rows of its own photons, so all
+        # apertures can share one buffer for the local coordinates.
+        intercoos = np.zeros((len(photons), 2))
 
         for i, elem in enumerate(self.elements):
             for p in self.preprocess_steps:
@@ -212,8 +515,7 @@ class MultiAperture(BaseAperture, BaseContainer):
             # elements. In other elements "intersect" decides
             # which photons are touched, here we pass that in.
             photons = elem.process_photons(photons, aperid==i,
-                                           photons['pos'],
-                                           np.zeros((len(photons), 2)))
+                                           photons['pos'], intercoos)
             for p in self.postprocess_steps:
                 p(photons)
         return photons
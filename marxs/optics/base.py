@@ -206,7 +206,10 @@ class OpticalElement(SimulationSequenceElement):
         if self.id_col is not None:
             photons[self.id_col][intersect] = self.id_num
         # Set position in different coordinate systems
-        photons['pos'][intersect] = interpos[intersect]
+        # Apertures write directly into the pos column and pass that column
+        # as interpos, so there is nothing to copy.
+        if interpos is not photons['pos']:
+            photons['pos'][intersect] = interpos[intersect]
 
         return photons
 
@@ -4,12 +4,15 @@ from astropy.coordinates import SkyCoord
 from astropy.table import Table
 import astropy.units as u
 import pytest
+from scipy.stats import kstest
 
 from ..aperture import CircleAperture, RectangleAperture, MultiAperture
+from .. import aperture
 from ...utils import generate_test_photons
 from ...source import FixedPointing
 from ...base import GeometryError
 from ...math.utils import h2e
+from transforms3d.axangles import axangle2mat
 
 def test_circle_phi():
     p = generate_test_photons(500)
@@ -52,6 +55,103 @@ def test_circle_radius():
     assert np.all(rad >= 15.)
     assert np.all(rad <= 25.)
 
+def test_circle_uniform_density():
+    '''Photons are distributed uniformly over the area of a ring segment.'''
+    c = CircleAperture(phi=[0.5, 2.], r_inner=1, zoom=[1, 2, 2], seed=0)
+    x, y = c.generate_local_xy(10000)
+    r2 = x**2 + y**2
+    phi = np.arctan2(y, x)
+    assert kstest((r2 - .25) / .75, 'uniform')[1] > 0.01
+    assert kstest((phi - .5) / 1.5, 'uniform')[1] > 0.01
+
+def test_seed():
+    '''Apertures with the same seed place photons at the same positions.'''
+    for aper in [RectangleAperture, CircleAperture]:
+        x1, y1 = aper(seed=42).generate_local_xy(10)
+        x2, y2 = aper(seed=42).generate_local_xy(10)
+        x3, y3 = aper(seed=43).generate_local_xy(10)
+        assert np.all(x1 == x2)
+        assert np.all(y1 == y2)
+        assert not np.all(x1 == x3)
+
+    def multi(seed):
+        return MultiAperture(elements=[CircleAperture(),
+                                       RectangleAperture(position=[0, 4, 0])],
+                             seed=seed)
+    pos = []
+    for seed in [42, 42, 43]:
+        p = generate_test_photons(10)
+        pos.append(multi(seed)(p)['pos'])
+    assert np.all(pos[0] == pos[1])
+    assert not np.all(pos[0] == pos[2])
+
+    # Elements assigned after construction are seeded, too.
+    pos = []
+    for seed in [42, 42]:
+        a = multi(seed)
+        a.elements = [RectangleAperture(), CircleAperture(position=[0, 4, 0])]
+        pos.append(a(generate_test_photons(10))['pos'])
+    assert np.all(pos[0] == pos[1])
+    assert a.elements[1].id_col == 'aperture'
+    assert a.elements[1].id_num == 1
+
+@pytest.mark.skipif('not aperture.HAS_NUMBA')
+def test_circle_numba_kernel():
+    '''Compare the compiled sampling kernel to the numpy expressions.'''
+    rand = np.random.default_rng(0).random((100, 2))
+    x = np.empty(100)
+    y = np.empty(100)
+    aperture._sample_annulus(rand, .5, 1.5, .25, .75, x, y)
+    phi = .5 + 1.5 * rand[:, 0]
+    r = np.sqrt(.25 + .75 * rand[:, 1])
+    assert np.allclose(x, r * np.cos(phi))
+    assert np.allclose(y, r * np.sin(phi))
+
+@pytest.mark.skipif('not aperture.HAS_NUMBA')
+def test_circle_use_numba(monkeypatch):
+    '''Switching off numba gives the same photon positions.'''
+    out = []
+    for use_numba in [True, False]:
+        monkeypatch.setattr(aperture, 'USE_NUMBA', use_numba)
+        a = CircleAperture(r_inner=.3, phi=[.5, 2.], seed=0)
+        out.append(a.generate_local_xy(100))
+    assert np.allclose(out[0][0], out[1][0])
+    assert np.allclose(out[0][1], out[1][1])
+
+def test_rectangle_stratify():
+    '''Stratified sampling puts exactly one photon in each cell.'''
+    a = RectangleAperture(stratify=True)
+    x, y = a.generate_local_xy(16)
+    hist, xedges, yedges = np.histogram2d(x, y, bins=4, range=[[-1, 1], [-1, 1]])
+    assert np.all(hist == 1)
+    # Not sorted by cell
+    assert not np.all(np.diff(x) >= 0)
+
+    x, y = a.generate_local_xy(10)
+    assert len(x) == 10
+    assert np.all(np.abs(x) <= 1)
+    assert np.all(np.abs(y) <= 1)
+
+@pytest.mark.skipif('not aperture.HAS_NUMBA')
+def test_numba_apply_numeric(monkeypatch):
+    '''The compiled kernel gives the same result as the numpy code.'''
+    a = RectangleAperture(position=[1, 2, 3], zoom=[1, 2, 3])
+    n = 50
+    x, y = a.generate_local_xy(n)
+    dir = np.random.normal(size=(n, 4))
+    dir[:, 3] = 0
+    dir /= np.linalg.norm(dir, axis=1)[:, None]
+    out = []
+    for use_numba in [True, False]:
+        monkeypatch.setattr(aperture, 'USE_NUMBA', use_numba)
+        pos = np.empty((n, 4))
+        prob = np.ones(n)
+        a._apply_numeric(pos, dir, prob, x, y)
+        out.append((pos, prob))
+    assert np.allclose(out[0][0], out[1][0])
+    assert np.allclose(out[0][1], out[1][1])
+    assert np.all(out[0][0][:, 3] == 1)
+
 def test_circle_area():
     '''Check that the area of rings and wedges comes out correctly.'''
     c = CircleAperture(zoom=[1, 2, 2])
@@ -87,6 +187,32 @@ def test_MultiAperture():
     assert not np.max(ind1) <  np.min(ind2)
     assert not np.min(ind1) > np.max(ind2)
 
+def test_MultiAperture_area():
+    '''The area is updated when the list of elements is replaced.'''
+    a1 = RectangleAperture()
+    a2 = RectangleAperture(position=[0, 4, 0], zoom=2)
+    a = MultiAperture(elements=[a1, a2])
+    assert u.isclose(a.area, 20 * u.mm**2)
+    a.elements = [a1]
+    assert u.isclose(a.area, 4 * u.mm**2)
+
+    a = MultiAperture(elements=[])
+    assert a.area == 0
+
+
+def test_MultiAperture_rescaled_element():
+    '''Area and split of photons follow elements changed after construction.'''
+    a1 = RectangleAperture()
+    a2 = RectangleAperture(position=[0, 4, 0])
+    a = MultiAperture(elements=[a1, a2])
+    assert u.isclose(a.area, 8 * u.mm**2)
+    a2.geometry.pos4d = a2.geometry.pos4d @ np.diag([1, 3, 3, 1])
+    assert u.isclose(a2.area, 36 * u.mm**2)
+    assert u.isclose(a.area, 40 * u.mm**2)
+    p = generate_test_photons(10000)
+    p = a(p)
+    assert np.isclose((p['aperture'] == 1).sum() / 10000, 0.9, atol=0.02)
+
 def test_geomarea_projection():
     '''When a ray sees the aperture under an angle the projected aperture size
     is smaller. This is accounted for by reducing the probability of this photon.'''
@@ -110,3 +236,59 @@ def test_geomarea_projection():
     p = aper(photons.copy())
 
     assert np.allclose(p['probability'], [ 0, 1./np.sqrt(2), 1., 1./np.sqrt(2), 0.])
+
+def test_moved_aperture():
+    '''Apertures cache their geometry, but moving them must still work.'''
+    aper = RectangleAperture()
+    p = aper(generate_test_photons(10))
+    assert np.allclose(p['pos'][:, 0], 0)
+
+    aper.geometry.pos4d[0, 3] = 5.
+    p = aper(generate_test_photons(10))
+    assert np.allclose(p['pos'][:, 0], 5)
+
+@pytest.mark.parametrize('aper', [RectangleAperture, CircleAperture])
+def test_float32(aper):
+    '''Positions can be generated in single precision.'''
+    p = generate_test_photons(10)
+    p.remove_column('pos')
+    a = aper(zoom=2)
+    a.dtype = np.float32
+    p = a(p)
+    assert p['pos'].dtype == np.float32
+    assert np.all(np.abs(p['pos'][:, 1:3]) <= 2)
+    assert np.all(p['pos'][:, 3] == 1)
+
+def test_geomarea_projection_multiaperture():
+    '''Projection effects are also applied to subsets of photons.'''
+    p = generate_test_photons(100)
+    p['dir'] = np.tile([-1, 1, 0, 0] / np.sqrt(2), (100, 1))
+    a = MultiAperture(elements=[RectangleAperture(),
+                                RectangleAperture(position=[0, 4, 0])])
+    p = a(p)
+    assert np.allclose(p['probability'], 1. / np.sqrt(2))
+    assert set(p['aperture']) == {0, 1}
+
+@pytest.mark.parametrize('use_numba', [True, False])
+def test_geomarea_projection_rounding(monkeypatch, use_numba):
+    '''Rounding errors must not push probabilities above 1.
+
+    Look for an orientation where the dot product of the normalized e_x with
+    itself is slightly larger than 1. Whether that happens depends on the
+    platform rounding, so skip if there is none.
+    '''
+    if use_numba and not aperture.HAS_NUMBA:
+        pytest.skip('numba is not installed')
+    monkeypatch.setattr(aperture, 'USE_NUMBA', use_numba)
+    for angle in range(1, 90):
+        aper = RectangleAperture(orientation=axangle2mat([1, 1, 0],
+                                                         np.deg2rad(angle)))
+        ex = aper.geometry['e_x']
+        if np.dot(ex, ex) > 1:
+            break
+    else:
+        pytest.skip('No orientation with rounding errors found.')
+    p = generate_test_photons(10)
+    p['dir'] = np.tile(-ex, (10, 1))
+    p = aper(p)
+    assert np.all(p['probability'] <= 1)
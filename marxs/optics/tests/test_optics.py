@@ -62,8 +62,8 @@ def test_pos4d_translation():
 
 mark = pytest.mark.parametrize
 
-all_slits = [marxs.optics.aperture.RectangleAperture(zoom=2),
-             marxs.optics.aperture.RectangleAperture(zoom=[2,2,2]),
+all_slits = [marxs.optics.aperture.RectangleAperture(zoom=2, seed=0),
+             marxs.optics.aperture.RectangleAperture(zoom=[2,2,2], seed=0),
             ]
 
 @mark('myslit', all_slits)
@@ -87,7 +87,8 @@ def test_pos4d_transforms_slit_rotated(photons1000):
     p = photons1000
 
     rotation = axangle2aff(np.array([0, 1, 0]), np.deg2rad(90))
-    myslit = marxs.optics.aperture.RectangleAperture(orientation=rotation[:3, :3], zoom=0.5)
+    myslit = marxs.optics.aperture.RectangleAperture(orientation=rotation[:3, :3], zoom=0.5,
+                                                     seed=0)
     p = myslit(p)
     assert np.allclose(p['pos'][:, 2], 0)
     assert kstest(p['pos'][:, 0] + 0.5, "uniform")[1] > 0.01